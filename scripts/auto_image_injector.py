@@ -2,43 +2,95 @@ import fitz
 import re
 import os
 import argparse
+import ahocorasick
+import numpy as np
 from pathlib import Path
-from thefuzz import fuzz
+from concurrent.futures import ProcessPoolExecutor
+from rapidfuzz import fuzz, process, utils
 
 
 class AdvancedImageProcessor:
-    def __init__(self, pdf_path, md_dir, output_dir, use_svg=True, threshold=85):
+    def __init__(self, pdf_path, md_dir, output_dir, threshold=85):
         self.pdf_path = Path(pdf_path)
         self.md_dir = Path(md_dir)
         self.output_dir = Path(output_dir)
-        self.use_svg = use_svg
         self.threshold = threshold
         self.assets_dir = self.output_dir / "assets"
         self.assets_dir.mkdir(parents=True, exist_ok=True)
+        self._page_text = {}
+        self._page_norm = {}
+        self._fig_regex = re.compile(r'(?:Figure|Fig)\s*(\d+[\.\-]\d+)', re.IGNORECASE)
 
-    def is_toc_page(self, page_text, current_ch_num, md_files):
-        matches = 0
-        for other_file in md_files:
-            other_num = int(other_file[:2])
-            if other_num > current_ch_num:
-                title = other_file[3:-3].replace('_', ' ').lower()
-                if fuzz.partial_ratio(title, page_text.lower()) > 80:
-                    matches += 1
-        return matches >= 1
-
-    def find_chapter_starts(self, doc, md_files):
+    def get_text(self, doc, p_idx):
+        """Extracts a page's text once; PyMuPDF re-parses the content stream on every call."""
+        if p_idx not in self._page_text:
+            self._page_text[p_idx] = doc[p_idx].get_text()
+        return self._page_text[p_idx]
+
+    def get_text_norm(self, doc, p_idx):
+        """Page text run through rapidfuzz's default_process (lower-cased, punctuation-free), cached."""
+        if p_idx not in self._page_norm:
+            self._page_norm[p_idx] = utils.default_process(self.get_text(doc, p_idx))
+        return self._page_norm[p_idx]
+
+    def is_toc_page(self, title_hits, current_ch_num, ch_nums):
+        """Flags every page that also names a later chapter (TOC / Part intro pages)."""
+        return title_hits[ch_nums > current_ch_num].sum(axis=0) >= 1
+
+    def score_titles(self, titles, page_texts):
+        """Chapters x pages similarity matrix, scored once; anything below the cutoff is 0."""
+        scores = np.zeros((len(titles), len(page_texts)), dtype=np.float32)
+        # One automaton finds every exact title and every title's first word in a single pass per page
+        patterns = {}
+        for row, title in enumerate(titles):
+            patterns.setdefault(title, []).append((True, row))
+            patterns.setdefault((title.split() or [''])[0], []).append((False, row))
+        patterns.pop('', None)
+        if not patterns: return scores
+        automaton = ahocorasick.Automaton()
+        for key, hits in patterns.items():
+            automaton.add_word(key, hits)
+        automaton.make_automaton()
+
+        fuzzy_rows, fuzzy_pages = [], []
+        for p, text in enumerate(page_texts):
+            exact, first_word = set(), set()
+            for _, hits in automaton.iter(text):
+                for is_title, row in hits:
+                    (exact if is_title else first_word).add(row)
+            # An exact hit is a perfect partial_ratio; only pages that merely share the first word need fuzzing
+            scores[list(exact), p] = 100
+            for row in first_word - exact:
+                fuzzy_rows.append(row)
+                fuzzy_pages.append(p)
+        # Every remaining (title, page) pair goes to the scorer in a single multi-threaded C++ call.
+        # Scores are rounded to whole numbers, as thefuzz returned them, so the '>' cutoffs keep their edges.
+        scores[fuzzy_rows, fuzzy_pages] = np.rint(process.cpdist([titles[r] for r in fuzzy_rows],
+                                                                 [page_texts[p] for p in fuzzy_pages],
+                                                                 scorer=fuzz.partial_ratio, processor=None,
+                                                                 score_cutoff=min(80, self.threshold), workers=-1))
+        return scores
+
+    def list_chapters(self):
+        """(chapter number, normalized title, filename) for every numbered chapter file, parsed once."""
+        return sorted(((int(e.name[:2]), utils.default_process(e.name[3:-3]), e.name)
+                       for e in os.scandir(self.md_dir) if e.name.endswith('.md') and e.name[:1].isdigit()),
+                      key=lambda entry: entry[2])
+
+    def find_chapter_starts(self, doc, md_entries):
         pdf_mapping = []
         last_found = 0
         search_start = max(10, int(len(doc) * 0.03))
-        for filename in md_files:
-            ch_num = int(filename[:2])
-            title = filename[3:-3].replace('_', ' ').lower()
-            found_page = -1
-            for p_idx in range(max(last_found, search_start), len(doc)):
-                if fuzz.partial_ratio(title, doc[p_idx].get_text().lower()) > self.threshold:
-                    if self.is_toc_page(doc[p_idx].get_text(), ch_num, md_files): continue
-                    found_page = p_idx
-                    break
+        ch_nums = np.array([num for num, _, _ in md_entries])
+        titles = [title for _, title, _ in md_entries]
+        # Pages before search_start can never anchor a chapter, so they are never extracted or normalized
+        page_texts = [self.get_text_norm(doc, i) if i >= search_start else '' for i in range(len(doc))]
+        scores = self.score_titles(titles, page_texts)
+        title_hits = scores > 80
+        for row, (ch_num, _, filename) in enumerate(md_entries):
+            found = (scores[row] > self.threshold) & ~self.is_toc_page(title_hits, ch_num, ch_nums)
+            found[:max(last_found, search_start)] = False
+            found_page = int(found.argmax()) if found.any() else -1
             if found_page != -1:
                 pdf_mapping.append({"num": ch_num, "file": filename, "start_page": found_page})
                 last_found = found_page + 3
@@ -48,92 +100,184 @@ class AdvancedImageProcessor:
 
     def get_vector_clusters(self, page):
         """Groups vector paths with aggressive flowchart bridging."""
-        paths = page.get_drawings()
-        clusters = []
-        for p in paths:
-            r = fitz.Rect(p["rect"])
-            if r.width < 5 or r.height < 5: continue
-            merged = False
-            for i, c_rect in enumerate(clusters):
-                # 50pt bridge for complex diagrams like Fig 5.6
-                if r.intersects(fitz.Rect(c_rect.x0 - 50, c_rect.y0 - 50, c_rect.x1 + 50, c_rect.y1 + 50)):
-                    clusters[i] = c_rect | r
-                    merged = True
-                    break
-            if not merged: clusters.append(r)
-        return [c for c in clusters if c.width > 60 and c.height > 40]
-
-    def extract_visual(self, page, bbox, fig_id):
-        img_name = f"fig_{fig_id.replace('.', '_')}"
-        if self.use_svg:
-            try:
-                svg_data = page.get_svg_image(matrix=fitz.Identity, clip=bbox)
-                if "<path" in svg_data or "<text" in svg_data:
-                    with open(self.assets_dir / f"{img_name}.svg", "w") as f: f.write(svg_data)
-                    return f"assets/{img_name}.svg", "SVG"
-            except:
-                pass
-        pix = page.get_pixmap(matrix=fitz.Matrix(300 / 72, 300 / 72), clip=bbox + (-2, -2, 2, 2))
+        rects = [r for r in (fitz.Rect(p["rect"]) for p in page.get_drawings()) if r.width >= 5 and r.height >= 5]
+        return [c for c in self.bridge_clusters(rects, page.rect) if c.width > 60 and c.height > 40]
+
+    def bridge_clusters(self, rects, bounds, bridge=50, cell=100):
+        """
+        Unions every pair of paths within the bridge distance (50pt, for complex diagrams like Fig 5.6),
+        so a cluster is a connected component and does not depend on drawing order. A uniform grid
+        keeps the neighbour lookups near-linear on dense flowchart pages.
+        """
+        # Drawings are not clipped to the page; bucketing a huge background rect cell by cell
+        # would allocate millions of cells, so the grid only ever sees the page plus the bridge
+        area = bounds + (-bridge, -bridge, bridge, bridge)
+        clipped = [r & area for r in rects]
+        parent = list(range(len(rects)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def cells(r):
+            for gx in range(int(r.x0 // cell), int(r.x1 // cell) + 1):
+                for gy in range(int(r.y0 // cell), int(r.y1 // cell) + 1):
+                    yield gx, gy
+
+        grid = {}
+        for i, r in enumerate(clipped):
+            if r.is_empty: continue
+            reach = r + (-bridge, -bridge, bridge, bridge)
+            neighbours = set()
+            for key in cells(reach):
+                neighbours.update(grid.get(key, ()))
+            for j in neighbours:
+                if clipped[j].intersects(reach):
+                    parent[find(j)] = find(i)
+            for key in cells(r):
+                grid.setdefault(key, []).append(i)
+
+        clusters = {}
+        for i, r in enumerate(rects):
+            root = find(i)
+            clusters[root] = clusters[root] | r if root in clusters else fitz.Rect(r)
+        return list(clusters.values())
+
+    def extract_visual(self, page, bbox, fig_id, ch_num):
+        # Chapters run in parallel and cross-reference each other's figures; the chapter prefix
+        # keeps two workers from ever writing the same asset
+        img_name = f"ch{ch_num:02d}_fig_{fig_id.replace('.', '_')}"
+        # Nothing of the bbox lies on the page: skip the 300 DPI render entirely
+        clip = (bbox + (-2, -2, 2, 2)) & page.rect
+        if clip.is_empty: return None
+        pix = page.get_pixmap(matrix=fitz.Matrix(300 / 72, 300 / 72), clip=clip)
         pix.save(self.assets_dir / f"{img_name}.png")
         return f"assets/{img_name}.png", "PNG"
 
+    def find_captions(self, page):
+        """
+        Locates figure references from one 'rawdict' pass instead of a search_for() per match.
+        Each distinct reference keeps its first position, which is what search_for()[0] returned.
+        """
+        # Image blocks would copy every embedded image's bytes into the dict; only text lines are needed
+        flags = fitz.TEXTFLAGS_RAWDICT & ~fitz.TEXT_PRESERVE_IMAGES
+        text, boxes, line_ids = [], [], []
+        for block in page.get_text("rawdict", flags=flags)["blocks"]:
+            for line in block.get("lines", ()):
+                line_id = len(line_ids)
+                for span in line["spans"]:
+                    for c in span["chars"]:
+                        text.append(c["c"])
+                        boxes.append(c["bbox"])
+                        line_ids.append(line_id)
+                # Lines are joined with '\n' as in get_text(), so a reference wrapped onto the next line still matches
+                text.append("\n")
+                boxes.append(None)
+                line_ids.append(None)
+
+        captions = {}
+        for match in self._fig_regex.finditer("".join(text)):
+            key = " ".join(match.group(0).lower().split())
+            if key in captions: continue
+            # A wrapped reference is located by its part on the first line, like search_for()[0]
+            first_line = line_ids[match.start()]
+            rect = fitz.Rect(boxes[match.start()])
+            for k in range(match.start() + 1, match.end()):
+                if line_ids[k] == first_line:
+                    rect |= boxes[k]
+            captions[key] = (match.group(1), rect)
+        return list(captions.values())
+
+    def process_chapter(self, doc, item):
+        """Extracts one chapter's figures and writes its injected markdown; returns the log lines."""
+        log = []
+        with open(self.md_dir / item['file'], 'r') as f:
+            content = f.read()
+        fig_hooks = {}
+        for p_idx in range(item['start_page'], item['end_page']):
+            page = doc[p_idx]
+            if not self._fig_regex.search(self.get_text(doc, p_idx)): continue
+            captions = self.find_captions(page)
+            # get_drawings() is the costliest per-page call; only pay for it when a caption needs a match
+            if not captions: continue
+
+            candidates = []
+            max_area = 1
+            for img in page.get_image_info():
+                r = fitz.Rect(img['bbox'])
+                # GEOMETRIC FILTER: If height < 15, it's a watermark line, not a figure.
+                if r.height < 15: continue
+                candidates.append({'bbox': r, 'type': 'raster', 'area': r.get_area()})
+                max_area = max(max_area, r.get_area())
+            for v in self.get_vector_clusters(page):
+                candidates.append({'bbox': v, 'type': 'vector', 'area': v.get_area()})
+                max_area = max(max_area, v.get_area())
+
+            if not candidates: continue
+
+            # Captions x candidates distance scores in one broadcast
+            cand_boxes = np.array([tuple(c['bbox']) for c in candidates])
+            cand_area = np.array([c['area'] for c in candidates])
+            cap_boxes = np.array([tuple(r) for _, r in captions])
+            cap_y, cap_x = (cap_boxes[:, 1] + cap_boxes[:, 3]) / 2, (cap_boxes[:, 0] + cap_boxes[:, 2]) / 2
+            scores = (np.abs(cap_y[:, None] - (cand_boxes[:, 1] + cand_boxes[:, 3]) / 2)
+                      + np.abs(cap_x[:, None] - (cand_boxes[:, 0] + cand_boxes[:, 2]) / 2) * 0.4)
+            scores[cand_boxes[:, 3] < cap_y[:, None]] *= 0.5
+            # Aggressive penalty for tiny objects relative to the page's largest item
+            scores[:, cand_area < (max_area * 0.15)] *= 100.0
+
+            for (fig_id, _), best in zip(captions, scores.argmin(axis=1)):
+                visual = self.extract_visual(page, candidates[best]['bbox'], fig_id, item['num'])
+                if visual:
+                    path, v_type = visual
+                    fig_hooks[fig_id] = path
+                    log.append(f"  ✓ {v_type} Fig {fig_id} in {item['file']}")
+
+        if fig_hooks:
+            # One pattern and one pass for every figure; longest ids first so '1.10' is never claimed by '1.1'
+            ids = sorted(fig_hooks, key=len, reverse=True)
+            hook_re = re.compile(r'(?:Figure|Fig)\s*(' + '|'.join(map(re.escape, ids)) + ')')
+            pieces, last, injected = [], 0, set()
+            for match in hook_re.finditer(content):
+                fid = match.group(1)
+                if fid in injected: continue
+                injected.add(fid)
+                pieces += [content[last:match.start()], f"\n\n![Figure {fid}]({fig_hooks[fid]})\n\n"]
+                last = match.start()
+            content = ''.join(pieces) + content[last:]
+
+        with open(self.output_dir / item['file'], 'w') as f:
+            f.write(content)
+        return log
+
     def process(self):
         doc = fitz.open(self.pdf_path)
-        md_files = sorted([f for f in os.listdir(self.md_dir) if f.endswith('.md') and f[0:1].isdigit()])
-        mapping = self.find_chapter_starts(doc, md_files)
-        fig_regex = re.compile(r'(?:Figure|Fig)\s*(\d+[\.\-]\d+)', re.IGNORECASE)
+        mapping = self.find_chapter_starts(doc, self.list_chapters())
+        doc.close()
 
         print(f"\n--- EXTRACTING VISUALS (GEOMETRIC REJECTION) ---")
-        for item in mapping:
-            with open(self.md_dir / item['file'], 'r') as f:
-                content = f.read()
-            fig_hooks = {}
-            for p_idx in range(item['start_page'], item['end_page']):
-                page = doc[p_idx]
-                matches = list(fig_regex.finditer(page.get_text()))
-
-                candidates = []
-                max_area = 1
-                for img in page.get_image_info():
-                    r = fitz.Rect(img['bbox'])
-                    # GEOMETRIC FILTER: If height < 15, it's a watermark line, not a figure.
-                    if r.height < 15: continue
-                    candidates.append({'bbox': r, 'type': 'raster', 'area': r.get_area()})
-                    max_area = max(max_area, r.get_area())
-                for v in self.get_vector_clusters(page):
-                    candidates.append({'bbox': v, 'type': 'vector', 'area': v.get_area()})
-                    max_area = max(max_area, v.get_area())
-
-                for match in matches:
-                    fig_id = match.group(1)
-                    rects = page.search_for(match.group(0))
-                    if not rects: continue
-                    cap_y, cap_x = (rects[0].y0 + rects[0].y1) / 2, (rects[0].x0 + rects[0].x1) / 2
-
-                    best_bbox, min_score = None, float('inf')
-                    for cand in candidates:
-                        bbox = cand['bbox']
-                        score = abs(cap_y - (bbox.y0 + bbox.y1) / 2) + (abs(cap_x - (bbox.x0 + bbox.x1) / 2) * 0.4)
-                        if bbox.y1 < cap_y: score *= 0.5
-                        # Aggressive penalty for tiny objects relative to the page's largest item
-                        if cand['area'] < (max_area * 0.15): score *= 100.0
-                        if score < min_score: min_score, best_bbox = score, bbox
-
-                    if best_bbox:
-                        path, v_type = self.extract_visual(page, best_bbox, fig_id)
-                        fig_hooks[fig_id] = path
-                        print(f"  ✓ {v_type} Fig {fig_id} in {item['file']}")
-
-            # Fixed SyntaxWarning: Use a non-f-string for the replacement group
-            for fid, path in fig_hooks.items():
-                replacement = f"\n\n![Figure {fid}]({path})\n\n" + r"\g<0>"
-                content = re.sub(rf'(?:Figure|Fig)\s*{re.escape(fid)}', replacement, content, count=1)
-
-            with open(self.output_dir / item['file'], 'w') as f:
-                f.write(content)
+        # Chapters cover disjoint page ranges and write their own files, so they run in parallel
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            futures = [pool.submit(_process_chapter, self.pdf_path, self.md_dir, self.output_dir, item,
+                                   {p: self._page_text[p] for p in range(item['start_page'], item['end_page'])})
+                       for item in mapping]
+            # Print in chapter order so worker output never interleaves
+            for future in futures:
+                for line in future.result():
+                    print(line)
         print("✅ Success.")
 
 
+def _process_chapter(pdf_path, md_dir, output_dir, item, page_texts):
+    """Worker entry point: each process opens its own document, fitz handles can't be shared."""
+    processor = AdvancedImageProcessor(pdf_path, md_dir, output_dir)
+    processor._page_text.update(page_texts)
+    with fitz.open(pdf_path) as doc:
+        return processor.process_chapter(doc, item)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('pdf');
@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 import re
+import shutil
 import argparse
 from pathlib import Path
-from thefuzz import fuzz
+from rapidfuzz import fuzz, utils
 
 
 class ChapterCandidate:
-    def __init__(self, num, hint, line_idx, raw_text):
+    def __init__(self, num, hint, line_idx, raw_text, offset=0):
         self.num = num
         self.hint = hint
         self.line_idx = line_idx
         self.raw_text = raw_text
+        self.offset = offset
 
 
 class ElectionRefinedSplitter:
@@ -21,28 +23,52 @@ class ElectionRefinedSplitter:
         self.threshold = threshold
         self.output_dir.mkdir(parents=True, exist_ok=True)
         self.max_name_len = 80
+        self._chapter_re = re.compile(r'Chapter\s+(\d+)[:\-\s,]+(.*)', re.IGNORECASE)
+        self._page_ref_re = re.compile(r'[\s.]+ \d+$')
+        self._header_clean_re = re.compile(r'^[#\s*]+')
+        self._san_table = str.maketrans({c: '_' for c in map(chr, range(128)) if not c.isalnum()})
+        self._line_re = re.compile(rb'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')
 
     def sanitize_filename(self, name):
         """Standardizes names and enforces a safe length."""
-        clean = re.sub(r'[^a-zA-Z0-9]+', '_', name)
-        clean = re.sub(r'_+', '_', clean).strip('_')
+        # Non-ASCII characters become '?' first, so the ASCII-only table maps them to '_' too
+        clean = name.encode('ascii', 'replace').decode('ascii').translate(self._san_table)
+        clean = '_'.join(part for part in clean.split('_') if part)
         return clean[:self.max_name_len]
 
+    def iter_lines(self, f):
+        """Streams (byte offset, decoded line) pairs from a binary file instead of loading it whole."""
+        offset = f.tell()
+        for raw in f:
+            # Binary iteration only splits on '\n'; also split on lone '\r' like text mode's universal newlines
+            lines = self._line_re.findall(raw) if b'\r' in raw else (raw,)
+            for line in lines:
+                yield offset, line.decode('utf-8')
+                offset += len(line)
+
+    def copy_range(self, src, dst, length, chunk=1 << 20):
+        """Copies `length` bytes in 1 MB chunks so a large chapter is never held in memory whole."""
+        while length > 0:
+            data = src.read(min(chunk, length))
+            if not data: break
+            dst.write(data)
+            length -= len(data)
+
     def find_all_toc_clusters(self, lines):
         """Finds all potential chapter lists in the document."""
         clusters = []
         current_cluster = []
         last_line_idx = -1
 
-        for i, line in enumerate(lines):
+        for i, (offset, line) in enumerate(lines):
             clean = line.strip()
             # Match "Chapter 1", "Chapter 01"
-            match = re.search(r'Chapter\s+(\d+)[:\-\s,]+(.*)', clean, re.IGNORECASE)
+            match = self._chapter_re.search(clean)
 
             if match:
                 num = int(match.group(1))
-                hint = re.sub(r'[\s.]+ \d+$', '', match.group(2).strip())
-                candidate = ChapterCandidate(num, hint, i, clean)
+                hint = self._page_ref_re.sub('', match.group(2).strip())
+                candidate = ChapterCandidate(num, hint, i, clean, offset)
 
                 if last_line_idx != -1 and (i - last_line_idx) > self.toc_gap:
                     if current_cluster:
@@ -64,7 +90,7 @@ class ElectionRefinedSplitter:
             length = len(cluster)
             seq = sum(2 for i in range(len(cluster) - 1) if cluster[i + 1].num == cluster[i].num + 1)
             scored.append((length + seq, cluster))
-        return sorted(scored, key=lambda x: x[0], reverse=True)[0][1]
+        return max(scored, key=lambda x: x[0])[1]
 
     def refine_title(self, body_line, target_num):
         """
@@ -72,7 +98,7 @@ class ElectionRefinedSplitter:
         Removes 'Chapter X' and cleaning symbols to get just the name.
         """
         # Remove MD headers and Chapter markers
-        clean = re.sub(r'^[#\s*]+', '', body_line).strip()
+        clean = self._header_clean_re.sub('', body_line).strip()
         clean = re.sub(rf'^Chapter\s+{target_num}[:\-\s,]*', '', clean, flags=re.IGNORECASE).strip()
 
         # If the result is too short or just punctuation, it failed
@@ -86,10 +112,11 @@ class ElectionRefinedSplitter:
         return clean.strip()
 
     def run(self):
-        with open(self.input_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        with open(self.input_file, 'rb') as f:
+            self.split_stream(f)
 
-        true_toc = self.elect_best_cluster(self.find_all_toc_clusters(lines))
+    def split_stream(self, f):
+        true_toc = self.elect_best_cluster(self.find_all_toc_clusters(self.iter_lines(f)))
         if not true_toc:
             print("No valid TOC sequence found.")
             return
@@ -98,22 +125,30 @@ class ElectionRefinedSplitter:
         search_start_line = true_toc[-1].line_idx + 1
         split_points = [(0, "00_Front_Matter.md")]
         expected_ptr = 0
+        hdr_res = [re.compile(rf'^#+\s*Chapter\s+{c.num}\b', re.IGNORECASE) for c in true_toc]
+        hints = [utils.default_process(c.hint) for c in true_toc]
 
         print(f"\n--- SCANNING BODY (Starting line {search_start_line}) ---")
 
-        for i in range(search_start_line, len(lines)):
+        # Resume the stream right after the last TOC entry
+        f.seek(true_toc[-1].offset)
+        body = self.iter_lines(f)
+        next(body, None)
+        for i, (offset, line) in enumerate(body, start=search_start_line):
             if expected_ptr >= len(true_toc): break
 
             target = true_toc[expected_ptr]
-            line = lines[i]
             clean = line.strip()
 
             is_match = False
-            if re.match(rf'^#+\s*Chapter\s+{target.num}\b', clean, re.IGNORECASE):
+            if hdr_res[expected_ptr].match(clean):
                 is_match = True
             elif clean.startswith('#'):
-                clean_text = re.sub(r'^[#\s*]+', '', clean).strip()
-                if fuzz.partial_ratio(target.hint.lower(), clean_text.lower()) >= self.threshold:
+                # default_process lower-cases and drops the leading '#'/'*' markers in one pass
+                header = utils.default_process(clean)
+                # Rounded like thefuzz's scores; the cutoff is lowered by 0.5 so scores rounding up to it survive
+                score = round(fuzz.partial_ratio(hints[expected_ptr], header, score_cutoff=self.threshold - 0.5))
+                if score >= self.threshold:
                     is_match = True
 
             if is_match:
@@ -126,15 +161,20 @@ class ElectionRefinedSplitter:
                 filename = f"{target.num:02d}_{safe_name}.md"
 
                 print(f"  ✓ Found Ch {target.num} (Line {i + 1}) -> Refined to: '{title_for_file[:40]}...'")
-                split_points.append((i, filename))
+                split_points.append((offset, filename))
                 expected_ptr += 1
 
         print(f"\n--- SAVING {len(split_points)} FILES ---")
         for i in range(len(split_points)):
             start, fname = split_points[i]
-            end = split_points[i + 1][0] if i + 1 < len(split_points) else len(lines)
-            with open(self.output_dir / fname, 'w', encoding='utf-8') as out:
-                out.writelines(lines[start:end])
+            end = split_points[i + 1][0] if i + 1 < len(split_points) else None
+            # Copy the byte range straight from the source file
+            f.seek(start)
+            with open(self.output_dir / fname, 'wb') as out:
+                if end is None:
+                    shutil.copyfileobj(f, out, length=1 << 20)
+                else:
+                    self.copy_range(f, out, end - start)
             print(f"  Saved: {fname}")
 
 